@@ -1,9 +1,19 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 from datetime import datetime
 import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+from google.oauth2.service_account import Credentials
+from google.auth.transport.requests import AuthorizedSession
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import time
+import io
+import html
+import os
+import queue
+import threading
+import uuid
 
 # --- Configuração da Página ---
 st.set_page_config(
@@ -69,120 +79,595 @@ MERCADOS_DISPONIVEIS = {
 }
 
 # --- CONEXÃO GOOGLE SHEETS (Dinamica) ---
+def _sessao_http(creds):
+    # Sessão única (keep-alive) com retry para leituras que voltam 429/5xx.
+    # POSTs não são repetidos aqui: as gravações têm o próprio backoff na fila.
+    sessao = AuthorizedSession(creds)
+    retry = Retry(total=3, backoff_factor=0.2, status_forcelist=[429, 500, 503], raise_on_status=False)
+    sessao.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry))
+    return sessao
+
+@st.cache_resource
+def _get_client():
+    # Um cliente autenticado por processo, compartilhado por todos os mercados
+    scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
+    creds_dict = dict(st.secrets["gcp_service_account"])
+    creds = Credentials.from_service_account_info(creds_dict, scopes=scope)
+    return gspread.Client(auth=creds, session=_sessao_http(creds))
+
 @st.cache_resource
 def conectar_google_sheets(nome_planilha):
+    # Com o ID da planilha nos secrets ([planilhas_ids]) abre direto pela chave,
+    # sem a busca por nome no Drive; senão abre pelo nome passado no parâmetro
+    chave = st.secrets.get("planilhas_ids", {}).get(nome_planilha)
+    sheet = _get_client().open_by_key(chave) if chave else _get_client().open(nome_planilha)
+    return sheet
+
+@st.cache_resource
+def get_worksheets(nome_planilha):
+    # Guarda os handles das abas: sh.worksheet() busca os metadados a cada chamada
+    sh = conectar_google_sheets(nome_planilha)
+    return sh.worksheet("produtos"), sh.worksheet("historico")
+
+# --- CACHE L2 (Redis, diskcache ou snapshot parquet local) ---
+# Compartilha os dados entre processos/reinícios; o st.cache_data só vale dentro de um processo.
+CACHE_L2_TTL = 300
+PASTA_SNAPSHOT = "./.cache"
+
+@st.cache_resource
+def _cache_l2():
+    url = st.secrets.get("REDIS_URL")
+    if url:
+        try:
+            import redis
+            r = redis.Redis.from_url(url)
+            r.ping()
+            return r
+        except Exception:
+            pass
     try:
-        scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
-        creds_dict = dict(st.secrets["gcp_service_account"])
-        creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
-        client = gspread.authorize(creds)
-        # Abre a planilha específica passada pelo parâmetro
-        sheet = client.open(nome_planilha) 
-        return sheet
-    except Exception as e:
+        import diskcache
+        return diskcache.Cache(PASTA_SNAPSHOT)
+    except ImportError:
         return None
 
-def load_data(nome_planilha):
-    sh = conectar_google_sheets(nome_planilha)
-    if not sh:
-        st.error(f"🚨 Não achei a planilha: {nome_planilha}. Verifique o nome no Google Drive e se compartilhou com o robô.")
-        return pd.DataFrame(), pd.DataFrame()
+@st.cache_resource
+def _versoes_dados():
+    # Versão dos dados de cada planilha (compartilhada pelo processo); entra na chave do load_data
+    return {}
+
+def versao_dados(nome_planilha):
+    return _versoes_dados().get(nome_planilha, 0)
+
+def _chave_versao_l2(nome_planilha):
+    return f"mercado:{nome_planilha}:versao"
+
+def _chaves_l2(nome_planilha, versao):
+    # A versão faz parte da chave: depois do INCR, dados lidos antes da gravação ficam inalcançáveis
+    return f"mercado:{nome_planilha}:{versao}:produtos", f"mercado:{nome_planilha}:{versao}:historico"
+
+def _versao_l2(nome_planilha):
+    # Versão compartilhada entre processos/workers; sem Redis/diskcache vale a do processo.
+    # None se o L2 não responder (aí ele não é lido nem gravado)
+    cache = _cache_l2()
+    if cache is None:
+        return versao_dados(nome_planilha)
+    try:
+        return int(cache.get(_chave_versao_l2(nome_planilha)) or 0)
+    except Exception:
+        return None
+
+def _arquivos_snapshot(nome_planilha):
+    return [os.path.join(PASTA_SNAPSHOT, f"mercado_{nome_planilha}_{aba}.parquet") for aba in ("produtos", "historico")]
+
+def _snapshot_get(nome_planilha):
+    # Sem Redis/diskcache: usa os parquet locais se ainda estiverem dentro do TTL
+    try:
+        arquivos = _arquivos_snapshot(nome_planilha)
+        if any(time.time() - os.path.getmtime(a) > CACHE_L2_TTL for a in arquivos):
+            return None
+        return tuple(pd.read_parquet(a, engine="pyarrow") for a in arquivos)
+    except Exception:
+        return None
+
+def _snapshot_set(nome_planilha, df_prod, df_hist):
+    try:
+        os.makedirs(PASTA_SNAPSHOT, exist_ok=True)
+        for arquivo, df in zip(_arquivos_snapshot(nome_planilha), (df_prod, df_hist)):
+            df.to_parquet(arquivo, engine="pyarrow")
+    except Exception:
+        pass
+
+def _snapshot_delete(nome_planilha):
+    for arquivo in _arquivos_snapshot(nome_planilha):
+        try:
+            os.remove(arquivo)
+        except OSError:
+            pass
+
+def _l2_get(nome_planilha, versao):
+    if versao is None:
+        return None
+    cache = _cache_l2()
+    if cache is None:
+        return _snapshot_get(nome_planilha)
+    try:
+        blobs = [cache.get(k) for k in _chaves_l2(nome_planilha, versao)]
+        if not all(blobs):
+            return None
+        return tuple(pd.read_parquet(io.BytesIO(b)) for b in blobs)
+    except Exception:
+        return None
 
+def _l2_set(nome_planilha, versao, df_prod, df_hist):
+    # Se uma gravação (de qualquer worker) terminou durante a leitura, os dados podem ser
+    # de antes dela e não vão para o L2
+    if versao is None or _versao_l2(nome_planilha) != versao:
+        return
+    cache = _cache_l2()
+    if cache is None:
+        _snapshot_set(nome_planilha, df_prod, df_hist)
+        # Os arquivos não têm versão: cobre a gravação que termine entre o teste e o set
+        if versao_dados(nome_planilha) != versao:
+            _snapshot_delete(nome_planilha)
+        return
     try:
-        ws_prod = sh.worksheet("produtos")
-        data_prod = ws_prod.get_all_records()
-        df_prod = pd.DataFrame(data_prod)
-
-        ws_hist = sh.worksheet("historico")
-        data_hist = ws_hist.get_all_records()
-        df_hist = pd.DataFrame(data_hist)
-
-        if not df_prod.empty:
-            cols = ['ID', 'Preco', 'Estoque_Atual', 'Estoque_Minimo']
-            for c in cols:
-                if c in df_prod.columns:
-                    df_prod[c] = pd.to_numeric(df_prod[c], errors='coerce').fillna(0)
-            df_prod = df_prod.sort_values(by='Produto', ascending=True)
-
-        if not df_hist.empty:
-            cols_h = ['Produto_ID', 'Qtd', 'Preco_Na_Epoca']
-            for c in cols_h:
-                if c in df_hist.columns:
-                    df_hist[c] = pd.to_numeric(df_hist[c], errors='coerce').fillna(0)
-                    
-        return df_prod, df_hist
-    except Exception as e:
-        return pd.DataFrame(), pd.DataFrame()
-
-def save_data(nome_planilha, df_prod, df_hist):
+        for chave, df in zip(_chaves_l2(nome_planilha, versao), (df_prod, df_hist)):
+            blob = df.to_parquet()
+            if hasattr(cache, 'setex'):
+                cache.setex(chave, CACHE_L2_TTL, blob)
+            else:
+                cache.set(chave, blob, expire=CACHE_L2_TTL)
+    except Exception:
+        pass
+
+def invalidar_cache(nome_planilha):
+    # Após uma gravação: nova versão no L2 (vale para todos os workers) e no processo.
+    # Só a planilha gravada é recarregada; os outros mercados continuam em cache
+    cache = _cache_l2()
+    if cache is None:
+        _snapshot_delete(nome_planilha)
+    else:
+        try:
+            cache.incr(_chave_versao_l2(nome_planilha))
+        except Exception:
+            pass
+    versoes = _versoes_dados()
+    versoes[nome_planilha] = versoes.get(nome_planilha, 0) + 1
+
+def _montar_df(valores):
+    # Primeira linha é o cabeçalho; linhas mais curtas são completadas com None e
+    # células além do cabeçalho (anotações feitas à mão na planilha) são ignoradas
+    if len(valores) < 2:
+        return pd.DataFrame()
+    cab = valores[0]
+    return pd.DataFrame([r[:len(cab)] for r in valores[1:]], columns=cab)
+
+@st.cache_data(ttl=300, show_spinner=False)
+def load_data(nome_planilha, versao=0):
+    versao_cache = _versao_l2(nome_planilha)
+    em_cache = _l2_get(nome_planilha, versao_cache)
+    if em_cache is not None:
+        return em_cache
+
+    sh = conectar_google_sheets(nome_planilha)
+    # Uma única requisição traz as duas abas como listas de valores
+    resp = sh.values_batch_get(["produtos", "historico"])
+    df_prod, df_hist = (_montar_df(vr.get('values', [])) for vr in resp['valueRanges'])
+
+    if not df_prod.empty:
+        cols = ['ID', 'Preco', 'Estoque_Atual', 'Estoque_Minimo']
+        for c in cols:
+            if c in df_prod.columns:
+                df_prod[c] = pd.to_numeric(df_prod[c], errors='coerce').fillna(0)
+        # IDs e contagens são inteiros pequenos; preços ficam em float64 (float32 erra os centavos)
+        df_prod = df_prod.astype({c: np.int32 for c in ['ID', 'Estoque_Atual', 'Estoque_Minimo'] if c in df_prod.columns})
+        # Textos repetidos/curtos como categoria: códigos inteiros em vez de um str por linha
+        df_prod = df_prod.astype({c: 'category' for c in ['Produto', 'Marca'] if c in df_prod.columns})
+        df_prod = df_prod.sort_values(by='Produto', ascending=True)
+
+    if not df_hist.empty:
+        cols_h = ['Produto_ID', 'Qtd', 'Preco_Na_Epoca']
+        for c in cols_h:
+            if c in df_hist.columns:
+                df_hist[c] = pd.to_numeric(df_hist[c], errors='coerce').fillna(0)
+        df_hist = df_hist.astype({c: np.int32 for c in ['Produto_ID', 'Qtd'] if c in df_hist.columns})
+        # Formato fixo evita a inferência por valor; cache=True reaproveita datas repetidas
+        df_hist['Data'] = pd.to_datetime(df_hist['Data'], format=FORMATO_DATA, cache=True, errors='coerce')
+        # Categórico: os filtros por Tipo comparam códigos inteiros, não strings
+        df_hist['Tipo'] = df_hist['Tipo'].astype(TIPOS_HIST)
+
+    _l2_set(nome_planilha, versao_cache, df_prod, df_hist)
+    return df_prod, df_hist
+
+# Ordem das colunas nas abas (é a mesma que o app sempre gravou)
+COLS_PROD = ['ID', 'Produto', 'Marca', 'Preco', 'Estoque_Atual', 'Estoque_Minimo']
+COLS_HIST = ['Data', 'Produto_ID', 'Tipo', 'Qtd', 'Preco_Na_Epoca']
+TIPOS_HIST = pd.CategoricalDtype(['LEVANTAMENTO', 'COMPRA'])
+# Formato da coluna Data (ISO 8601 com espaço, o que já existe nas planilhas)
+FORMATO_DATA = "%Y-%m-%d %H:%M:%S"
+
+def agora():
+    return datetime.now().strftime(FORMATO_DATA)
+
+def _nativo(valor):
+    # Converte escalares do numpy para tipos Python (o gspread serializa em JSON)
+    return valor.item() if hasattr(valor, 'item') else valor
+
+def _linhas(registros, cols):
+    return [[_nativo(r[c]) for c in cols] for r in registros]
+
+def _garantir_cabecalho(ws, cols):
+    # Aba nova/vazia: grava o cabeçalho antes do primeiro append
+    if not ws.row_values(1):
+        ws.append_row(cols, value_input_option='RAW')
+
+def alteracoes_produtos(df_prod, changed_ids, colunas):
+    # {ID: [valores]} dos produtos alterados, só nas colunas que a ação mexeu
+    dados = df_prod.loc[changed_ids, colunas]
+    return {int(pid): [_nativo(v) for v in valores] for pid, valores in zip(dados.index, dados.itertuples(index=False))}
+
+def _linhas_por_id(sh):
+    # {ID: linha}, lido da coluna A na hora de gravar (a posição muda se alguém insere/exclui linhas)
+    valores = sh.values_get("produtos!A:A").get('values', [])
+    linhas, repetidos = {}, set()
+    for linha, celula in enumerate(valores[1:], start=2):
+        try:
+            pid = int(float(celula[0]))
+        except (IndexError, ValueError):
+            continue
+        if pid in linhas:
+            repetidos.add(pid)
+        linhas[pid] = linha
+    for pid in repetidos:
+        del linhas[pid]
+    return linhas
+
+def _linha_do_produto(linhas, pid):
+    # Sem linha certa para o ID, a gravação falha inteira em vez de escrever na linha errada
+    if pid not in linhas:
+        raise ValueError(f"Produto ID {pid} não encontrado (ou repetido) na aba produtos; nada foi gravado.")
+    return linhas[pid]
+
+def _celula(valor):
+    valor = _nativo(valor)
+    if isinstance(valor, (int, float)) and not isinstance(valor, bool):
+        return {'userEnteredValue': {'numberValue': valor}}
+    return {'userEnteredValue': {'stringValue': str(valor)}}
+
+def _append_cells(ws, registros, cols):
+    # Request appendCells: acrescenta os registros após a última linha com dados
+    return {'appendCells': {
+        'sheetId': ws.id,
+        'rows': [{'values': [_celula(v) for v in linha]} for linha in _linhas(registros, cols)],
+        'fields': 'userEnteredValue',
+    }}
+
+def commit_cart(nome_planilha, colunas, alteracoes, logs, hist_vazio=False):
+    # Compra ou contagem num único batchUpdate: só as colunas alteradas de cada produto + os registros do histórico
+    sh = conectar_google_sheets(nome_planilha)
+    ws_prod, ws_hist = get_worksheets(nome_planilha)
+    if not logs:
+        return
+    linhas = _linhas_por_id(sh) if alteracoes else {}
+    coluna = COLS_PROD.index(colunas[0])
+    requests = []
+    for pid, valores in alteracoes.items():
+        linha = _linha_do_produto(linhas, pid)
+        requests.append({'updateCells': {
+            'start': {'sheetId': ws_prod.id, 'rowIndex': linha - 1, 'columnIndex': coluna},
+            'rows': [{'values': [_celula(v) for v in valores]}],
+            'fields': 'userEnteredValue',
+        }})
+    if hist_vazio: _garantir_cabecalho(ws_hist, COLS_HIST)
+    requests.append(_append_cells(ws_hist, logs, COLS_HIST))
+    sh.batch_update({'requests': requests})
+
+def cadastrar_produto(nome_planilha, novo, log, prod_vazia=False, hist_vazio=False):
+    # Produto novo e levantamento inicial num único batchUpdate
+    sh = conectar_google_sheets(nome_planilha)
+    ws_prod, ws_hist = get_worksheets(nome_planilha)
+    if prod_vazia: _garantir_cabecalho(ws_prod, COLS_PROD)
+    if hist_vazio: _garantir_cabecalho(ws_hist, COLS_HIST)
+    sh.batch_update({'requests': [
+        _append_cells(ws_prod, [novo], COLS_PROD),
+        _append_cells(ws_hist, [log], COLS_HIST),
+    ]})
+
+def delete_product(nome_planilha, pid):
+    # Remove só a linha do produto, achada pelo ID na hora de gravar
     sh = conectar_google_sheets(nome_planilha)
-    if sh:
-        ws_prod = sh.worksheet("produtos")
-        ws_prod.clear()
-        ws_prod.update([df_prod.columns.values.tolist()] + df_prod.values.tolist())
-        
-        ws_hist = sh.worksheet("historico")
-        ws_hist.clear()
-        ws_hist.update([df_hist.columns.values.tolist()] + df_hist.values.tolist())
+    ws_prod, _ = get_worksheets(nome_planilha)
+    linha = _linha_do_produto(_linhas_por_id(sh), int(pid))
+    sh.batch_update({'requests': [{'deleteDimension': {'range': {
+        'sheetId': ws_prod.id, 'dimension': 'ROWS', 'startIndex': linha - 1, 'endIndex': linha,
+    }}}]})
+
+# --- FILA DE GRAVAÇÃO (segundo plano) ---
+# As gravações saem da thread da interface: a tela é atualizada na hora com uma
+# cópia local e uma thread única por processo envia tudo à planilha, em ordem.
+TENTATIVAS_GRAVACAO = 5
+
+def _com_backoff(funcao, *args):
+    # Repete com espera exponencial só quando a API pede para diminuir o ritmo (429):
+    # a requisição foi recusada antes de aplicar. Um 5xx pode chegar depois do
+    # batchUpdate já gravado, e repetir duplicaria os appendCells do histórico.
+    for tentativa in range(TENTATIVAS_GRAVACAO):
+        try:
+            return funcao(*args)
+        except gspread.exceptions.APIError as e:
+            status = e.response.status_code if e.response is not None else None
+            if status != 429 or tentativa == TENTATIVAS_GRAVACAO - 1:
+                raise
+            time.sleep(2 ** tentativa)
+
+MAX_RESULTADOS = 500
+
+def _processar_fila(fila, resultados):
+    while True:
+        id_gravacao, nome_planilha, funcao, args = fila.get()
+        erro = None
+        try:
+            _com_backoff(funcao, nome_planilha, *args)
+        except Exception as e:
+            erro = str(e)
+        finally:
+            invalidar_cache(nome_planilha)
+            # Resultado por gravação: só a sessão que guardou o id vai buscá-lo.
+            # Os mais antigos (de sessões que já fecharam) são descartados.
+            resultados[id_gravacao] = erro
+            while len(resultados) > MAX_RESULTADOS:
+                resultados.pop(next(iter(resultados)))
+            fila.task_done()
+
+@st.cache_resource
+def fila_escrita():
+    # Fila + thread de gravação, compartilhadas por todas as sessões do processo
+    fila, resultados = queue.Queue(), {}
+    threading.Thread(target=_processar_fila, args=(fila, resultados), daemon=True).start()
+    return fila, resultados
+
+def enfileirar(nome_planilha, descricao, funcao, *args):
+    # Põe a gravação na fila e anota o id dela nesta sessão
+    id_gravacao = uuid.uuid4().hex
+    st.session_state.setdefault('gravacoes_pendentes', {})[id_gravacao] = descricao
+    fila_escrita()[0].put((id_gravacao, nome_planilha, funcao, args))
+
+def conferir_gravacoes():
+    # Move as falhas desta sessão para erros_gravacao (ficam lá até o usuário dispensar)
+    _, resultados = fila_escrita()
+    pendentes = st.session_state.get('gravacoes_pendentes', {})
+    for id_gravacao in [i for i in pendentes if i in resultados]:
+        descricao = pendentes.pop(id_gravacao)
+        erro = resultados.pop(id_gravacao)
+        if erro:
+            st.session_state.setdefault('erros_gravacao', []).append(f"{descricao}: {erro}")
+    return bool(pendentes)
+
+@st.fragment(run_every=2)
+def acompanhar_gravacoes():
+    # Enquanto houver gravações desta sessão na fila, confere a cada 2 s e
+    # recarrega a página quando alguma termina (para mostrar falhas na hora)
+    pendentes = st.session_state.get('gravacoes_pendentes', {})
+    _, resultados = fila_escrita()
+    if any(i in resultados for i in pendentes):
+        st.rerun()
+
+def guardar_local(df_prod, df_hist, novos_hist=()):
+    # Mostra as alterações já enfileiradas até a fila terminar de gravar
+    if novos_hist:
+        novos = pd.DataFrame(list(novos_hist))
+        novos['Data'] = pd.to_datetime(novos['Data'], format=FORMATO_DATA, cache=True, errors='coerce')
+        novos['Tipo'] = novos['Tipo'].astype(TIPOS_HIST)
+        df_hist = pd.concat([df_hist, novos], ignore_index=True)
+    st.session_state.dados_locais = (df_prod, df_hist)
 
 # --- FUNÇÕES AUXILIARES ---
-def calcular_sugestao(row, df_hist):
-    prod_id = row['ID']
-    estoque_atual = row['Estoque_Atual']
-    estoque_minimo = row['Estoque_Minimo']
+def _somar_compras(df_hist, par):
+    # Soma das COMPRAs de cada par (produto, dt_anterior, dt_atual] com cumsum + buscas binárias
+    compras = df_hist[(df_hist['Tipo'] == 'COMPRA') & df_hist['Data'].notna()]
+    posicao = par.index.get_indexer(compras['Produto_ID'])
+    ok = posicao >= 0
+    c_seg = compras['Data'].to_numpy(dtype='datetime64[s]').astype(np.int64)[ok]
+    c_qtd = compras['Qtd'].to_numpy(dtype=np.float64)[ok]
+    ant_seg = par['dt_anterior'].to_numpy(dtype='datetime64[s]').astype(np.int64)
+    atual_seg = par['dt_atual'].to_numpy(dtype='datetime64[s]').astype(np.int64)
 
-    hist = df_hist[df_hist['Produto_ID'] == prod_id].sort_values(by='Data', ascending=False)
-    levs = hist[hist['Tipo'] == 'LEVANTAMENTO']
-    
-    sugestao = 0
-    motivo = ""
-    
-    if len(levs) >= 2:
-        ultimo = levs.iloc[0]
-        penultimo = levs.iloc[1]
-        dt_atual = datetime.strptime(ultimo['Data'], "%Y-%m-%d %H:%M:%S")
-        dt_anterior = datetime.strptime(penultimo['Data'], "%Y-%m-%d %H:%M:%S")
-        dias = (dt_atual - dt_anterior).days
-        if dias == 0: dias = 1
-        
-        mask_compras = (hist['Tipo'] == 'COMPRA') & \
-                       (pd.to_datetime(hist['Data']) > dt_anterior) & \
-                       (pd.to_datetime(hist['Data']) <= dt_atual)
-        compras = hist.loc[mask_compras, 'Qtd'].sum()
-        consumido = (penultimo['Qtd'] + compras) - ultimo['Qtd']
-        if consumido < 0: consumido = 0
-        consumo_mensal = (consumido / dias) * 30
-        
-        if consumo_mensal > estoque_atual:
-            sugestao = consumo_mensal - estoque_atual
-            motivo = f"Média consumo: {consumo_mensal:.1f}"
-    else:
-        if estoque_minimo > estoque_atual:
-            sugestao = estoque_minimo - estoque_atual
-            motivo = f"Abaixo do mínimo"
-    return int(sugestao + 0.9), motivo
+    t0 = min(ant_seg.min(), c_seg.min()) if len(c_seg) else ant_seg.min()
+    chave = (posicao[ok].astype(np.int64) << 34) + (c_seg - t0)
+    ordem = np.argsort(chave, kind='stable')
+    chave = chave[ordem]
+    acumulado = np.concatenate(([0.0], np.cumsum(c_qtd[ordem])))
+
+    base = np.arange(len(par), dtype=np.int64) << 34
+    inicio = np.searchsorted(chave, base + (ant_seg - t0), side='right')
+    fim = np.searchsorted(chave, base + (atual_seg - t0), side='right')
+    return acumulado[fim] - acumulado[inicio]
+
+def _consumo_mensal(df_hist):
+    # Consumo mensal por Produto_ID a partir dos dois últimos LEVANTAMENTOs
+    levs = df_hist[(df_hist['Tipo'] == 'LEVANTAMENTO') & df_hist['Data'].notna()].sort_values(by=['Produto_ID', 'Data'])
+    par = levs.groupby('Produto_ID').tail(2).groupby('Produto_ID').agg(
+        dt_anterior=('Data', 'first'), dt_atual=('Data', 'last'),
+        qtd_anterior=('Qtd', 'first'), qtd_atual=('Qtd', 'last'),
+        n=('Data', 'size'),
+    )
+    par = par[par['n'] == 2]
+    if par.empty:
+        return pd.Series(dtype=float)
+
+    soma_compras = pd.Series(_somar_compras(df_hist, par), index=par.index)
+
+    dias = (par['dt_atual'] - par['dt_anterior']).dt.days.replace(0, 1)
+    consumido = (par['qtd_anterior'] + soma_compras - par['qtd_atual']).clip(lower=0)
+    return (consumido / dias) * 30
+
+def proximo_id(df_prod, df_hist):
+    # Maior ID já usado + 1; olha o histórico para não reaproveitar o ID de um produto excluído
+    maior = 0
+    if not df_prod.empty: maior = max(maior, int(df_prod['ID'].max()))
+    if not df_hist.empty: maior = max(maior, int(df_hist['Produto_ID'].max()))
+    return maior + 1
+
+def _fingerprint(df_prod, df_hist):
+    # Chave barata que muda com qualquer alteração de estoque ou do histórico,
+    # inclusive correções de Qtd/Tipo feitas à mão em linhas antigas
+    prod = int(pd.util.hash_pandas_object(df_prod[['ID', 'Estoque_Atual', 'Estoque_Minimo']], index=False).sum())
+    hist = int(pd.util.hash_pandas_object(df_hist[['Data', 'Produto_ID', 'Tipo', 'Qtd']], index=False).sum()) if not df_hist.empty else 0
+    return prod, hist
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def calcular_sugestoes(nome_planilha, chave, _df_prod, _df_hist):
+    # Sugestão e motivo de todos os produtos, em cache por planilha + `chave` (ver _fingerprint)
+    df_prod, df_hist = _df_prod, _df_hist
+    consumo = _consumo_mensal(df_hist) if not df_hist.empty else pd.Series(dtype=float)
+    atual = df_prod['Estoque_Atual']
+    minimo = df_prod['Estoque_Minimo']
+    media = df_prod['ID'].map(consumo)
+    tem_media = media.notna()
+
+    falta_media = (media - atual).where(media > atual, 0)
+    falta_minimo = (minimo - atual).where(minimo > atual, 0)
+    sugestao = np.ceil(falta_media.where(tem_media, falta_minimo).to_numpy()).astype(np.int64)
+
+    motivo = pd.Series("", index=df_prod.index)
+    motivo[tem_media & (media > atual)] = media[tem_media & (media > atual)].map(lambda m: f"Média consumo: {m:.1f}")
+    motivo[~tem_media & (minimo > atual)] = "Abaixo do mínimo"
+    return pd.DataFrame({'sugestao': sugestao, 'motivo': motivo.to_numpy()}, index=df_prod['ID'].to_numpy())
 
 def renderizar_item_compra(row, sugestao, motivo):
-    estoque_atual = int(row['Estoque_Atual'])
-    ultimo_preco = float(row['Preco'])
+    estoque_atual = int(row.Estoque_Atual)
+    ultimo_preco = float(row.Preco)
     txt_preco_antigo = f"R$ {ultimo_preco:.2f}" if ultimo_preco > 0 else "--"
 
-    st.markdown(f"**{row['Produto']}**")
+    # Nome, info e sugestão num único st.markdown (um elemento a menos por linha a cada rerun)
+    html_sugestao = f"<span class='suggestion-highlight'>💡 Levar: {sugestao} un ({motivo})</span>" if sugestao > 0 else ""
     st.markdown(
-        f"""<div class="info-row">
-            <span class="info-item">📦 Estoque: <strong>{estoque_atual}</strong></span>
-            <span class="info-item">💲 Último: <strong>{txt_preco_antigo}</strong></span>
+        f"""<div><strong>{html.escape(str(row.Produto))}</strong>
+            <div class="info-row">
+                <span class="info-item">📦 Estoque: <strong>{estoque_atual}</strong></span>
+                <span class="info-item">💲 Último: <strong>{txt_preco_antigo}</strong></span>
+            </div>{html_sugestao}
         </div>""", unsafe_allow_html=True
     )
-    
-    if sugestao > 0:
-        st.markdown(f"<span class='suggestion-highlight'>💡 Levar: {sugestao} un ({motivo})</span>", unsafe_allow_html=True)
-    
-    c1, c2 = st.columns(2)
-    st.number_input("Qtd Comprar", min_value=0, step=1, key=f"qtd_{row['ID']}")
-    st.number_input("R$ Valor Unit.", min_value=0.0, value=ultimo_preco, step=0.01, format="%.2f", key=f"prc_{row['ID']}")
+
+    st.number_input("Qtd Comprar", min_value=0, step=1, key=f"qtd_{row.ID}")
+    st.number_input("R$ Valor Unit.", min_value=0.0, value=ultimo_preco, step=0.01, format="%.2f", key=f"prc_{row.ID}")
     st.divider()
 
+def finalizar_compra(nome_planilha, df_produtos, df_historico, ids):
+    # Callback do FINALIZAR COMPRA: roda antes do rerun, então zera as quantidades sem st.rerun() extra
+    df_produtos = df_produtos.copy()
+    compras = []
+    total = 0.0
+    now = agora()
+    for pid in ids:
+        qtd = st.session_state.get(f"qtd_{pid}", 0)
+        if qtd > 0:
+            preco = st.session_state.get(f"prc_{pid}", 0.0)
+            total += qtd * preco
+            df_produtos.at[pid, 'Estoque_Atual'] += qtd
+            df_produtos.at[pid, 'Preco'] = preco
+            compras.append({'Data': now, 'Produto_ID': pid, 'Tipo': 'COMPRA', 'Qtd': qtd, 'Preco_Na_Epoca': preco})
+
+    if not compras:
+        st.session_state.resultado_compra = None
+        return
+    colunas = ['Preco', 'Estoque_Atual']
+    alteracoes = alteracoes_produtos(df_produtos, [c['Produto_ID'] for c in compras], colunas)
+    itens = ", ".join(f"{c['Qtd']}x {df_produtos.at[c['Produto_ID'], 'Produto']}" for c in compras)
+    enfileirar(nome_planilha, f"Compra ({itens})", commit_cart, colunas, alteracoes, compras, df_historico.empty)
+    guardar_local(df_produtos, df_historico, compras)
+    for pid in ids: st.session_state[f"qtd_{pid}"] = 0
+    st.session_state.resultado_compra = total
+
+# --- ABAS (fragmentos) ---
+# Widgets dentro de um fragmento só reexecutam o próprio fragmento, não o app inteiro.
+@st.fragment
+def render_carrinho(df_produtos, df_historico):
+    if df_produtos.empty:
+        st.info("Cadastre produtos na aba 'Gerenciar'.")
+    else:
+        sugestoes = calcular_sugestoes(st.session_state.nome_planilha_ativa, _fingerprint(df_produtos, df_historico), df_produtos, df_historico)
+        sugestoes = sugestoes.reindex(df_produtos.index).fillna({'sugestao': 0, 'motivo': ""})
+        # Separa recomendados/opcionais com uma máscara, sem montar listas linha a linha
+        recomendar = sugestoes['sugestao'].to_numpy() > 0
+        itens = df_produtos[['ID', 'Produto', 'Preco', 'Estoque_Atual']].assign(
+            sugestao=sugestoes['sugestao'].astype(np.int64), motivo=sugestoes['motivo'])
+        df_recomendados = itens[recomendar]
+        df_opcionais = itens[~recomendar]
+
+        # Total = produto escalar das quantidades pelos preços digitados (ou o último preço)
+        inputs_qtd_ids = df_produtos['ID'].tolist()
+        precos_padrao = df_produtos['Preco'].to_numpy(dtype=np.float64)
+        qtds = np.fromiter((st.session_state.get(f"qtd_{pid}", 0) for pid in inputs_qtd_ids), dtype=np.int64, count=len(inputs_qtd_ids))
+        precos = np.fromiter((st.session_state.get(f"prc_{pid}", p) for pid, p in zip(inputs_qtd_ids, precos_padrao)), dtype=np.float64, count=len(inputs_qtd_ids))
+        total_carrinho_real_time = float(qtds @ precos)
+
+        st.markdown(f"""<div class="total-box">R$ Total: {total_carrinho_real_time:.2f}</div>""", unsafe_allow_html=True)
+
+        with st.expander(f"⚠️ Recomendados ({len(df_recomendados)})", expanded=True):
+            if df_recomendados.empty: st.caption("Nenhum item crítico.")
+            for row in df_recomendados.itertuples(index=False): renderizar_item_compra(row, row.sugestao, row.motivo)
+
+        with st.expander(f"✅ Outros / Estoque OK ({len(df_opcionais)})", expanded=False):
+            # Só cria os widgets de todos os opcionais quando pedido; os que já estão
+            # no carrinho continuam sempre visíveis para não perder as chaves qtd_/prc_
+            if st.toggle("Mostrar todos", key="mostrar_opcionais"):
+                visiveis = df_opcionais
+            else:
+                visiveis = df_opcionais[qtds[~recomendar] > 0]
+            for row in visiveis.itertuples(index=False): renderizar_item_compra(row, 0, "")
+
+        if st.button("✅ FINALIZAR COMPRA", type="primary", on_click=finalizar_compra,
+                     args=(st.session_state.nome_planilha_ativa, df_produtos, df_historico, inputs_qtd_ids)):
+            # O fragmento reroda sozinho; o rerun completo atualiza as outras abas
+            st.rerun()
+        if 'resultado_compra' in st.session_state:
+            total_compra = st.session_state.pop('resultado_compra')
+            if total_compra is None:
+                st.warning("Selecione algum produto.")
+            else:
+                st.balloons()
+                st.success(f"Compra registrada! Total: R$ {total_compra:.2f}")
+
+@st.fragment
+def render_estoque(df_produtos, df_historico):
+    st.markdown("### Auditoria de Estoque")
+    if df_produtos.empty:
+        st.info("Sem produtos.")
+    else:
+        with st.form("form_estoque"):
+            inputs_estoque = {}
+            for row in df_produtos[['ID', 'Produto', 'Estoque_Atual']].itertuples(index=False):
+                c1, c2 = st.columns([2, 1])
+                c1.markdown(f"**{row.Produto}**")
+                c1.caption(f"Sistema: {int(row.Estoque_Atual)}")
+                # O estoque entra na chave: se ele mudar (ex.: após uma compra) o campo volta ao valor novo
+                inputs_estoque[row.ID] = c2.number_input("Real", min_value=0, step=1, value=int(row.Estoque_Atual), key=f"est_{row.ID}_{int(row.Estoque_Atual)}", label_visibility="collapsed")
+                st.markdown("---")
+
+            if st.form_submit_button("💾 SALVAR CONTAGEM"):
+                # Diferença vetorizada: inputs_estoque segue a mesma ordem de df_produtos
+                novos = np.fromiter(inputs_estoque.values(), dtype=np.int64, count=len(inputs_estoque))
+                mudou = novos != df_produtos['Estoque_Atual'].to_numpy().astype(np.int64)
+                alterados = df_produtos.index[mudou].tolist()
+
+                if alterados:
+                    now = agora()
+                    df_produtos = df_produtos.copy()
+                    df_produtos.loc[alterados, 'Estoque_Atual'] = novos[mudou].astype(df_produtos['Estoque_Atual'].dtype)
+                    logs = [{'Data': now, 'Produto_ID': pid, 'Tipo': 'LEVANTAMENTO', 'Qtd': qtd, 'Preco_Na_Epoca': 0}
+                            for pid, qtd in zip(alterados, novos[mudou].tolist())]
+                    nome_planilha = st.session_state.nome_planilha_ativa
+                    alteracoes_prod = alteracoes_produtos(df_produtos, alterados, ['Estoque_Atual'])
+                    enfileirar(nome_planilha, f"Contagem de estoque ({len(logs)} produto(s))", commit_cart, ['Estoque_Atual'], alteracoes_prod, logs, df_historico.empty)
+                    guardar_local(df_produtos, df_historico, logs)
+                    st.session_state.aviso = "Estoque atualizado!"
+                    st.rerun()
+                else:
+                    st.info("Nenhuma alteração.")
+
 # --- LÓGICA DE SESSÃO (LOGIN) ---
 if 'mercado_ativo' not in st.session_state:
     st.session_state.mercado_ativo = None
@@ -213,9 +698,70 @@ else:
     if col_sair.button("Sair"):
         st.session_state.mercado_ativo = None
         st.session_state.nome_planilha_ativa = None
+        st.session_state.pop('dados_locais', None)
+        st.session_state.pop('dados_sessao', None)
         st.rerun()
 
-    df_produtos, df_historico = load_data(st.session_state.nome_planilha_ativa)
+    fila, _ = fila_escrita()
+    if conferir_gravacoes():
+        acompanhar_gravacoes()
+    if st.session_state.get('erros_gravacao'):
+        for erro in st.session_state.erros_gravacao:
+            st.error(f"🚨 Não foi salvo na planilha — {erro}")
+        if st.button("Ok, entendi"):
+            st.session_state.erros_gravacao = []
+            st.rerun()
+    if 'aviso' in st.session_state:
+        st.success(st.session_state.pop('aviso'))
+
+    # Com gravações pendentes, a tela usa a cópia local (já atualizada)
+    if fila.unfinished_tasks == 0:
+        st.session_state.pop('dados_locais', None)
+    # Os DataFrames não são alterados no lugar (quem grava trabalha numa cópia),
+    # então podem ser reaproveitados entre reruns sem copiar
+    if 'dados_locais' in st.session_state:
+        df_produtos, df_historico = st.session_state.dados_locais
+    else:
+        nome_planilha = st.session_state.nome_planilha_ativa
+        chave = (nome_planilha, versao_dados(nome_planilha))
+        dados_sessao = st.session_state.get('dados_sessao')
+        # Só prepara os dados de novo quando a versão muda ou o TTL do load_data vence
+        if dados_sessao is None or dados_sessao[0] != chave or time.time() - dados_sessao[1] > 300:
+            try:
+                df_produtos, df_historico = load_data(*chave)
+            except gspread.exceptions.SpreadsheetNotFound:
+                st.error(f"🚨 Não achei a planilha: {nome_planilha}. Verifique o nome no Google Drive e se compartilhou com o robô.")
+                st.button("Tentar de novo")
+                st.stop()
+            except Exception as e:
+                # Falhas de conexão/leitura sobem como exceção e os caches do Streamlit não as
+                # guardam: o "Tentar de novo" lê de novo. Sem os dados reais não dá para
+                # mostrar as abas (um cadastro reusaria IDs)
+                st.error(f"🚨 Não consegui ler a planilha {nome_planilha}: {e}")
+                st.button("Tentar de novo")
+                st.stop()
+            # Indexado por ID (mantendo a coluna) para acesso direto com .at
+            if not df_produtos.empty:
+                df_produtos = df_produtos.set_index('ID', drop=False)
+            # Próximo ID livre: calculado uma vez por versão dos dados, depois só incrementa
+            st.session_state.proximo_id = proximo_id(df_produtos, df_historico)
+            st.session_state.dados_sessao = (chave, time.time(), df_produtos, df_historico)
+        else:
+            _, _, df_produtos, df_historico = dados_sessao
+    # IDs (na ordem dos nomes), mapa ID -> nome e nomes normalizados para checar
+    # duplicados no cadastro em O(1). Só são refeitos quando o DataFrame de produtos
+    # muda (nova leitura, cadastro ou exclusão), não a cada rerun.
+    nomes_cache = st.session_state.get('nomes_cache')
+    if nomes_cache is None or nomes_cache[0] is not df_produtos:
+        nomes_produtos = df_produtos['Produto'].tolist() if not df_produtos.empty else []
+        nomes_cache = (
+            df_produtos,
+            df_produtos.index.tolist(),
+            dict(zip(df_produtos.index, nomes_produtos)),
+            frozenset(str(n).strip().lower() for n in nomes_produtos),
+        )
+        st.session_state.nomes_cache = nomes_cache
+    _, ids_produtos, nome_por_id, nomes_existentes = nomes_cache
 
     tab_carrinho, tab_estoque, tab_gerenciar = st.tabs([
         "🛒 Fazer Compras", "🏠 Estoque Casa", "⚙️ Gerenciar"
@@ -223,95 +769,11 @@ else:
 
     # --- ABA 1: CARRINHO ---
     with tab_carrinho:
-        if df_produtos.empty:
-            st.info("Cadastre produtos na aba 'Gerenciar'.")
-        else:
-            lista_recomendados = []
-            lista_opcionais = []
-            total_carrinho_real_time = 0.0
-            inputs_qtd_ids = [] 
-            
-            for idx, row in df_produtos.iterrows():
-                sugestao, motivo = calcular_sugestao(row, df_historico)
-                item_data = {'row': row, 'sugestao': sugestao, 'motivo': motivo}
-                if sugestao > 0:
-                    lista_recomendados.append(item_data)
-                else:
-                    lista_opcionais.append(item_data)
-                
-                k_qtd = f"qtd_{row['ID']}"
-                k_prc = f"prc_{row['ID']}"
-                qtd_atual = st.session_state.get(k_qtd, 0)
-                prc_atual = st.session_state.get(k_prc, float(row['Preco']))
-                total_carrinho_real_time += (qtd_atual * prc_atual)
-                inputs_qtd_ids.append(row['ID'])
-
-            st.markdown(f"""<div class="total-box">R$ Total: {total_carrinho_real_time:.2f}</div>""", unsafe_allow_html=True)
-
-            with st.expander(f"⚠️ Recomendados ({len(lista_recomendados)})", expanded=True):
-                if not lista_recomendados: st.caption("Nenhum item crítico.")
-                for item in lista_recomendados: renderizar_item_compra(item['row'], item['sugestao'], item['motivo'])
-
-            with st.expander(f"✅ Outros / Estoque OK ({len(lista_opcionais)})", expanded=False):
-                for item in lista_opcionais: renderizar_item_compra(item['row'], 0, "")
-
-            if st.button("✅ FINALIZAR COMPRA", type="primary"):
-                compras = []
-                now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                for pid in inputs_qtd_ids:
-                    qtd = st.session_state.get(f"qtd_{pid}", 0)
-                    if qtd > 0:
-                        preco = st.session_state.get(f"prc_{pid}", 0.0)
-                        df_produtos.loc[df_produtos['ID'] == pid, 'Estoque_Atual'] += qtd
-                        df_produtos.loc[df_produtos['ID'] == pid, 'Preco'] = preco
-                        compras.append({'Data': now, 'Produto_ID': pid, 'Tipo': 'COMPRA', 'Qtd': qtd, 'Preco_Na_Epoca': preco})
-                
-                if compras:
-                    with st.spinner("Salvando..."):
-                        df_historico = pd.concat([df_historico, pd.DataFrame(compras)], ignore_index=True)
-                        save_data(st.session_state.nome_planilha_ativa, df_produtos, df_historico)
-                    st.balloons()
-                    st.success(f"Compra registrada! Total: R$ {total_carrinho_real_time:.2f}")
-                    for pid in inputs_qtd_ids: st.session_state[f"qtd_{pid}"] = 0
-                    time.sleep(2)
-                    st.rerun()
-                else:
-                    st.warning("Selecione algum produto.")
+        render_carrinho(df_produtos, df_historico)
 
     # --- ABA 2: ESTOQUE ---
     with tab_estoque:
-        st.markdown("### Auditoria de Estoque")
-        if df_produtos.empty:
-            st.info("Sem produtos.")
-        else:
-            with st.form("form_estoque"):
-                inputs_estoque = {}
-                for idx, row in df_produtos.iterrows():
-                    c1, c2 = st.columns([2, 1])
-                    c1.markdown(f"**{row['Produto']}**")
-                    c1.caption(f"Sistema: {int(row['Estoque_Atual'])}")
-                    inputs_estoque[row['ID']] = c2.number_input("Real", min_value=0, step=1, value=int(row['Estoque_Atual']), key=f"est_{row['ID']}", label_visibility="collapsed")
-                    st.markdown("---")
-
-                if st.form_submit_button("💾 SALVAR CONTAGEM"):
-                    alteracoes = False
-                    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    logs = []
-                    for pid, novo_val in inputs_estoque.items():
-                        antigo = int(df_produtos.loc[df_produtos['ID'] == pid, 'Estoque_Atual'].values[0])
-                        if novo_val != antigo:
-                            alteracoes = True
-                            df_produtos.loc[df_produtos['ID'] == pid, 'Estoque_Atual'] = novo_val
-                            logs.append({'Data': now, 'Produto_ID': pid, 'Tipo': 'LEVANTAMENTO', 'Qtd': novo_val, 'Preco_Na_Epoca': 0})
-                    
-                    if alteracoes:
-                        df_historico = pd.concat([df_historico, pd.DataFrame(logs)], ignore_index=True)
-                        save_data(st.session_state.nome_planilha_ativa, df_produtos, df_historico)
-                        st.success("Estoque atualizado!")
-                        time.sleep(1)
-                        st.rerun()
-                    else:
-                        st.info("Nenhuma alteração.")
+        render_estoque(df_produtos, df_historico)
 
     # --- ABA 3: GERENCIAR ---
     with tab_gerenciar:
@@ -327,21 +789,19 @@ else:
                 if st.form_submit_button("Cadastrar"):
                     if nome:
                         nome_limpo = nome.strip()
-                        existentes = []
-                        if not df_produtos.empty: existentes = df_produtos['Produto'].astype(str).str.strip().str.lower().tolist()
-                        
-                        if nome_limpo.lower() in existentes:
+                        if nome_limpo.lower() in nomes_existentes:
                             st.error(f"⚠️ '{nome}' já existe!")
                         else:
-                            nid = 1 if df_produtos.empty else df_produtos['ID'].max() + 1
+                            nid = st.session_state.proximo_id
+                            st.session_state.proximo_id += 1
                             novo = {'ID': nid, 'Produto': nome_limpo, 'Marca': marca, 'Preco': 0.0, 'Estoque_Atual': est_ini, 'Estoque_Minimo': minimo}
-                            df_produtos = pd.concat([df_produtos, pd.DataFrame([novo])], ignore_index=True)
-                            log = {'Data': datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 'Produto_ID': nid, 'Tipo': 'LEVANTAMENTO', 'Qtd': est_ini, 'Preco_Na_Epoca': 0}
-                            df_historico = pd.concat([df_historico, pd.DataFrame([log])], ignore_index=True)
-                            
-                            save_data(st.session_state.nome_planilha_ativa, df_produtos, df_historico)
-                            st.success(f"✅ {nome} cadastrado!")
-                            time.sleep(1)
+                            log = {'Data': agora(), 'Produto_ID': nid, 'Tipo': 'LEVANTAMENTO', 'Qtd': est_ini, 'Preco_Na_Epoca': 0}
+
+                            nome_planilha = st.session_state.nome_planilha_ativa
+                            enfileirar(nome_planilha, f"Cadastro de {nome_limpo}", cadastrar_produto, novo, log, df_produtos.empty, df_historico.empty)
+                            df_novo = pd.DataFrame([novo]).set_index('ID', drop=False)
+                            guardar_local(pd.concat([df_produtos, df_novo]).sort_values(by='Produto'), df_historico, [log])
+                            st.session_state.aviso = f"✅ {nome} cadastrado!"
                             st.rerun()
                     else:
                         st.warning("Nome obrigatório.")
@@ -349,12 +809,27 @@ else:
         st.write("---")
         with st.expander("🗑️ Excluir"):
             if not df_produtos.empty:
-                lista_prods = df_produtos['Produto'].tolist()
-                p_del = st.selectbox("Selecione:", lista_prods)
-                if st.button("Confirmar Exclusão"):
-                    df_produtos = df_produtos[df_produtos['Produto'] != p_del]
-                    save_data(st.session_state.nome_planilha_ativa, df_produtos, df_historico)
-                    st.error("Excluído!")
-                    time.sleep(1)
+                # Filtro no servidor: o selectbox recebe no máximo `limite` opções, não o catálogo todo
+                limite = 20
+                filtro = st.text_input("Filtrar", key="filtro_excluir").strip().lower()
+                if filtro:
+                    achados = df_produtos['Produto'].astype(str).str.lower().str.contains(filtro, regex=False).to_numpy()
+                    opcoes = df_produtos.index[achados][:limite].tolist()
+                    total_opcoes = int(achados.sum())
+                else:
+                    opcoes = ids_produtos[:limite]
+                    total_opcoes = len(ids_produtos)
+                if total_opcoes > limite:
+                    st.caption(f"Mostrando {limite} de {total_opcoes}. Digite no filtro para achar os outros.")
+
+                # A opção é o ID (nomes repetidos não se confundem); o nome é só o rótulo
+                pid = st.selectbox("Selecione:", opcoes, format_func=nome_por_id.get)
+                if pid is None:
+                    st.caption("Nenhum produto encontrado.")
+                elif st.button("Confirmar Exclusão"):
+                    p_del = nome_por_id[pid]
+                    enfileirar(st.session_state.nome_planilha_ativa, f"Exclusão de {p_del}", delete_product, pid)
+                    guardar_local(df_produtos.drop(index=pid), df_historico)
+                    st.session_state.aviso = f"🗑️ {p_del} excluído!"
                     st.rerun()
 